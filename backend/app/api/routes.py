@@ -1,8 +1,12 @@
+import json
+import logging
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from app.services.rag_engine import generate_response
+from app.services.rag_engine import generate_response, stream_response
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 class ChatRequest(BaseModel):
     query: str
@@ -18,6 +22,27 @@ async def chat(payload: ChatRequest):
         answer = await generate_response(payload.query, payload.model_id)
         return ChatResponse(answer=answer, model_used=payload.model_id)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        logger.exception("chat failure")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/chat/stream")
+async def chat_stream(payload: ChatRequest):
+    """
+    Server-Sent Events variant of /chat: each `data:` frame carries a
+    {"delta": "..."} chunk of the answer, followed by a final `done` event.
+    """
+    async def event_generator():
+        try:
+            async for delta in stream_response(payload.query, payload.model_id):
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+            yield f"event: done\ndata: {json.dumps({'model_used': payload.model_id})}\n\n"
+        except Exception as e:
+            logger.exception("chat stream failure")
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+
+    # An explicit encoding keeps GZipMiddleware from buffering the token stream
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "Content-Encoding": "identity"}
+    )
@@ -1,33 +1,57 @@
-import os
+from functools import lru_cache
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
 
-load_dotenv()
+_LOADED = False
+
+
+def _load_env():
+    global _LOADED
+    if not _LOADED:
+        load_dotenv()
+        _LOADED = True
+
 
 class Settings(BaseSettings):
+    # Frontend (CORS)
+    FRONTEND_ORIGIN: str = "http://localhost:5173"
+
     # GPT
-    AZURE_OPENAI_ENDPOINT: str = os.getenv("AZURE_OPENAI_ENDPOINT", "")
-    AZURE_OPENAI_KEY: str = os.getenv("AZURE_OPENAI_KEY", "")
-    AZURE_OPENAI_DEPLOYMENT: str = os.getenv("AZURE_OPENAI_DEPLOYMENT", "")
+    AZURE_OPENAI_ENDPOINT: str = ""
+    AZURE_OPENAI_KEY: str = ""
+    AZURE_OPENAI_DEPLOYMENT: str = ""
 
     # Claude
-    CLAUDE_ENDPOINT: str = os.getenv("CLAUDE_ENDPOINT", "")
-    CLAUDE_KEY: str = os.getenv("CLAUDE_KEY", "")
-    CLAUDE_DEPLOYMENT: str = os.getenv("CLAUDE_DEPLOYMENT", "")
+    CLAUDE_ENDPOINT: str = ""
+    CLAUDE_KEY: str = ""
+    CLAUDE_DEPLOYMENT: str = ""
 
     # Mistral
-    MISTRAL_ENDPOINT: str = os.getenv("MISTRAL_ENDPOINT", "")
-    MISTRAL_KEY: str = os.getenv("MISTRAL_KEY", "")
-    MISTRAL_DEPLOYMENT: str = os.getenv("MISTRAL_DEPLOYMENT", "")
+    MISTRAL_ENDPOINT: str = ""
+    MISTRAL_KEY: str = ""
+    MISTRAL_DEPLOYMENT: str = ""
 
     # Grok
-    GROK_ENDPOINT: str = os.getenv("GROK_ENDPOINT", "")
-    GROK_KEY: str = os.getenv("GROK_KEY", "")
-    GROK_DEPLOYMENT: str = os.getenv("GROK_DEPLOYMENT", "")
+    GROK_ENDPOINT: str = ""
+    GROK_KEY: str = ""
+    GROK_DEPLOYMENT: str = ""
 
     # Embedding
-    EMBEDDING_ENDPOINT: str = os.getenv("EMBEDDING_ENDPOINT", "")
-    EMBEDDING_KEY: str = os.getenv("EMBEDDING_KEY", "")
-    EMBEDDING_DEPLOYMENT: str = os.getenv("EMBEDDING_DEPLOYMENT", "")
+    EMBEDDING_ENDPOINT: str = ""
+    EMBEDDING_KEY: str = ""
+    EMBEDDING_DEPLOYMENT: str = ""
+
+    # Semantic Cache
+    CACHE_ENABLED: bool = True
+    CACHE_SIMILARITY_THRESHOLD: float = 0.9
+    CACHE_TTL_SECONDS: int = 300
+    CACHE_MAX_ENTRIES: int = 1000
+
+    # Reject entity-free, off-topic queries locally before the supervisor LLM
+    GUARDRAIL_PRECHECK: bool = False
+
 
-settings = Settings()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    _load_env()
+    return Settings()
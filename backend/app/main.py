@@ -1,18 +1,30 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from app.api.routes import router
+from app.config import get_settings
+from app.logging_config import setup_logging
+from app.services.azure_client_factory import close_clients
+
+setup_logging()
 
 app = FastAPI(title="Twining's HeritageBot")
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=[get_settings().FRONTEND_ORIGIN],
+    allow_methods=["POST", "GET"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=86400,
 )
+app.add_middleware(GZipMiddleware, minimum_size=500)
 
 app.include_router(router, prefix="/api/v1")
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_clients()
+
 @app.get("/")
 def read_root():
     return {"message": "Hey, Welcome to Twining's HeritageBot"}
@@ -1,24 +1,46 @@
+import asyncio
+import logging
+import httpx
 import requests
-from typing import Any, List, Optional
+from typing import Any, AsyncIterator, Iterator, List, Optional
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.embeddings import Embeddings
 from langchain_core.messages import BaseMessage, AIMessage, SystemMessage
-from langchain_core.outputs import ChatResult, ChatGeneration
-from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from pydantic import PrivateAttr
 
 # SDK Imports
 from azure.ai.inference import ChatCompletionsClient, EmbeddingsClient
+from azure.ai.inference.aio import ChatCompletionsClient as AsyncChatCompletionsClient
 from azure.core.credentials import AzureKeyCredential
 from azure.core.exceptions import HttpResponseError
-from openai import AzureOpenAI, OpenAI
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI
 
 try:
-    from anthropic import Anthropic
+    from anthropic import Anthropic, AsyncAnthropic
 except ImportError:
     Anthropic = None
+    AsyncAnthropic = None
 
-from app.config import settings
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+# Shared keep-alive pool for the REST embedding fallback
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_keepalive_connections=20)
+)
+
+
+async def close_clients():
+    await _HTTP.aclose()
+    for llm in _LLM_CACHE.values():
+        await llm.aclose()
 
 
 # --- 1. Chat Model Wrapper ---
@@ -29,6 +51,7 @@ class AzureMaaSChatModel(BaseChatModel):
     deployment_name: str
 
     _client: Any = PrivateAttr(default=None)
+    _async_client: Any = PrivateAttr(default=None)
 
     def __init__(self, provider: str, endpoint: str, api_key: str, deployment_name: str, **kwargs):
         super().__init__(
@@ -38,40 +61,40 @@ class AzureMaaSChatModel(BaseChatModel):
             deployment_name=deployment_name,
             **kwargs
         )
-        self._initialize_client()
+        self._client = self._initialize_client(use_async=False)
+        self._async_client = self._initialize_client(use_async=True)
 
-    def _initialize_client(self):
+    def _initialize_client(self, use_async: bool):
         if self.provider == "gpt":
             base_endpoint = self.endpoint
             if "/openai" in base_endpoint:
                 base_endpoint = base_endpoint.split("/openai")[0]
 
-            self._client = AzureOpenAI(
+            client_cls = AsyncAzureOpenAI if use_async else AzureOpenAI
+            return client_cls(
                 azure_endpoint=base_endpoint,
                 api_key=self.api_key,
                 api_version="2024-12-01-preview"
             )
 
         elif self.provider == "mistral":
-            self._client = ChatCompletionsClient(
+            client_cls = AsyncChatCompletionsClient if use_async else ChatCompletionsClient
+            return client_cls(
                 endpoint=self.endpoint,
                 credential=AzureKeyCredential(self.api_key),
             )
         elif self.provider == "grok":
-            self._client = OpenAI(base_url=self.endpoint, api_key=self.api_key)
+            client_cls = AsyncOpenAI if use_async else OpenAI
+            return client_cls(base_url=self.endpoint, api_key=self.api_key)
         elif self.provider == "claude":
             if Anthropic:
-                self._client = Anthropic(api_key=self.api_key, base_url=self.endpoint)
+                client_cls = AsyncAnthropic if use_async else Anthropic
+                return client_cls(api_key=self.api_key, base_url=self.endpoint)
             else:
                 raise ImportError("Anthropic SDK not installed.")
 
-    def _generate(
-            self,
-            messages: List[BaseMessage],
-            stop: Optional[List[str]] = None,
-            run_manager: Optional[CallbackManagerForLLMRun] = None,
-            **kwargs: Any
-    ) -> ChatResult:
+    @staticmethod
+    def _format_messages(messages: List[BaseMessage]) -> List[dict]:
         formatted_messages = []
         for msg in messages:
             role = "user"
@@ -80,53 +103,159 @@ class AzureMaaSChatModel(BaseChatModel):
             elif isinstance(msg, AIMessage):
                 role = "assistant"
             formatted_messages.append({"role": role, "content": msg.content})
+        return formatted_messages
+
+    def _build_request(self, messages: List[BaseMessage], **kwargs: Any) -> dict:
+        """Provider-specific request arguments, shared by the sync and async paths."""
+        formatted_messages = self._format_messages(messages)
+
+        if self.provider == "gpt":
+            return dict(
+                model=self.deployment_name,
+                messages=formatted_messages,
+                # temperature=kwargs.get("temperature", 0.7),
+                max_completion_tokens=kwargs.get("max_tokens", 1024)  # Renamed from max_tokens
+            )
 
+        elif self.provider == "mistral":
+            return dict(
+                messages=formatted_messages,
+                model=self.deployment_name,
+                temperature=kwargs.get("temperature", 0.3)
+            )
+
+        elif self.provider == "grok":
+            return dict(
+                model=self.deployment_name,
+                messages=formatted_messages,
+                temperature=kwargs.get("temperature", 0.3)
+            )
+
+        elif self.provider == "claude":
+            system_msg = next((m['content'] for m in formatted_messages if m['role'] == 'system'), "")
+            user_msgs = [m for m in formatted_messages if m['role'] != 'system']
+            return dict(
+                model=self.deployment_name,
+                messages=user_msgs,
+                system=system_msg,
+                max_tokens=1024,
+                temperature=kwargs.get("temperature", 0.3)
+            )
+
+    def _send(self, client: Any, request: dict, stream: bool = False):
+        """Issues the completion call; returns a coroutine when given an async client."""
+        if stream:
+            request = {**request, "stream": True}
+        if self.provider in ("gpt", "grok"):
+            return client.chat.completions.create(**request)
+        elif self.provider == "mistral":
+            return client.complete(**request)
+        elif self.provider == "claude":
+            return client.messages.create(**request)
+
+    def _extract_content(self, response: Any) -> str:
+        if self.provider == "claude":
+            return response.content[0].text
+        return response.choices[0].message.content
+
+    @staticmethod
+    def _extract_delta(chunk: Any) -> str:
+        if chunk.choices and chunk.choices[0].delta.content:
+            return chunk.choices[0].delta.content
+        return ""
+
+    def _generate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> ChatResult:
         content = ""
         try:
-            if self.provider == "gpt":
-                response = self._client.chat.completions.create(
-                    model=self.deployment_name,
-                    messages=formatted_messages,
-                    # temperature=kwargs.get("temperature", 0.7),
-                    max_completion_tokens=kwargs.get("max_tokens", 1024)  # Renamed from max_tokens
-                )
-                content = response.choices[0].message.content
-
-            elif self.provider == "mistral":
-                response = self._client.complete(
-                    messages=formatted_messages,
-                    model=self.deployment_name,
-                    temperature=kwargs.get("temperature", 0.3)
-                )
-                content = response.choices[0].message.content
-
-            elif self.provider == "grok":
-                response = self._client.chat.completions.create(
-                    model=self.deployment_name,
-                    messages=formatted_messages,
-                    temperature=kwargs.get("temperature", 0.3)
-                )
-                content = response.choices[0].message.content
-
-            elif self.provider == "claude":
-                system_msg = next((m['content'] for m in formatted_messages if m['role'] == 'system'), "")
-                user_msgs = [m for m in formatted_messages if m['role'] != 'system']
-                response = self._client.messages.create(
-                    model=self.deployment_name,
-                    messages=user_msgs,
-                    system=system_msg,
-                    max_tokens=1024,
-                    temperature=kwargs.get("temperature", 0.3)
-                )
-                content = response.content[0].text
+            response = self._send(self._client, self._build_request(messages, **kwargs))
+            content = self._extract_content(response)
+        except Exception as e:
+            logger.exception(f"{self.provider} generation failed")
+            content = f"Error generating response: {str(e)}"
+
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
 
+    async def _agenerate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> ChatResult:
+        content = ""
+        try:
+            response = await self._send(self._async_client, self._build_request(messages, **kwargs))
+            content = self._extract_content(response)
         except Exception as e:
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"{self.provider} generation failed")
             content = f"Error generating response: {str(e)}"
 
         return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
 
+    def _stream_deltas(self, request: dict) -> Iterator[str]:
+        if self.provider == "claude":
+            with self._client.messages.stream(**request) as stream:
+                for text in stream.text_stream:
+                    yield text
+        else:
+            for chunk in self._send(self._client, request, stream=True):
+                delta = self._extract_delta(chunk)
+                if delta:
+                    yield delta
+
+    async def _astream_deltas(self, request: dict) -> AsyncIterator[str]:
+        if self.provider == "claude":
+            async with self._async_client.messages.stream(**request) as stream:
+                async for text in stream.text_stream:
+                    yield text
+        else:
+            async for chunk in await self._send(self._async_client, request, stream=True):
+                delta = self._extract_delta(chunk)
+                if delta:
+                    yield delta
+
+    def _stream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> Iterator[ChatGenerationChunk]:
+        try:
+            for delta in self._stream_deltas(self._build_request(messages, **kwargs)):
+                if run_manager:
+                    run_manager.on_llm_new_token(delta)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=delta))
+        except Exception as e:
+            logger.exception(f"{self.provider} generation failed")
+            yield ChatGenerationChunk(message=AIMessageChunk(content=f"Error generating response: {str(e)}"))
+
+    async def _astream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        try:
+            async for delta in self._astream_deltas(self._build_request(messages, **kwargs)):
+                if run_manager:
+                    await run_manager.on_llm_new_token(delta)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=delta))
+        except Exception as e:
+            logger.exception(f"{self.provider} generation failed")
+            yield ChatGenerationChunk(message=AIMessageChunk(content=f"Error generating response: {str(e)}"))
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+
     @property
     def _llm_type(self) -> str:
         return f"azure-maas-{self.provider}"
@@ -144,35 +273,67 @@ class AzureMaaSEmbeddings(Embeddings):
         self.key = key
         self.model_name = model_name
 
+    def _fallback_request(self, texts: List[str]):
+        headers = {
+            "Authorization": f"Bearer {self.key}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "input": texts,
+            "model": self.model_name,
+            "encoding_format": "float"
+        }
+        return headers, payload
+
+    @staticmethod
+    def _parse_fallback(data: dict) -> List[List[float]]:
+        if "data" in data:
+            return [item["embedding"] for item in data["data"]]
+        if "embeddings" in data:
+            return data["embeddings"]
+        raise ValueError("Unknown embedding format")
+
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         try:
             response = self.client.embed(input=texts, model=self.model_name)
             return [item.embedding for item in response.data]
         except HttpResponseError:
-            url = self.base_endpoint
-            headers = {
-                "Authorization": f"Bearer {self.key}",
-                "Content-Type": "application/json"
-            }
-            payload = {
-                "input": texts,
-                "model": self.model_name,
-                "encoding_format": "float"
-            }
-            r = requests.post(url, json=payload, headers=headers)
+            headers, payload = self._fallback_request(texts)
+            r = requests.post(self.base_endpoint, json=payload, headers=headers)
             r.raise_for_status()
-            data = r.json()
-            if "data" in data:
-                return [item["embedding"] for item in data["data"]]
-            if "embeddings" in data:
-                return data["embeddings"]
-            raise ValueError("Unknown embedding format")
+            return self._parse_fallback(r.json())
 
     def embed_query(self, text: str) -> List[float]:
         return self.embed_documents([text])[0]
 
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        try:
+            response = await asyncio.to_thread(self.client.embed, input=texts, model=self.model_name)
+            return [item.embedding for item in response.data]
+        except HttpResponseError:
+            headers, payload = self._fallback_request(texts)
+            r = await _HTTP.post(self.base_endpoint, json=payload, headers=headers)
+            r.raise_for_status()
+            return self._parse_fallback(r.json())
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
 
-def get_llm(model_id: str):
+    async def aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embeds many strings in one round trip; duplicates are sent once."""
+        if not texts:
+            return []
+        unique = list(dict.fromkeys(texts))
+        vectors = dict(zip(unique, await self.aembed_documents(unique)))
+        return [vectors[t] for t in texts]
+
+
+# One chat model (and SDK client / connection pool) per provider
+_LLM_CACHE: dict[str, AzureMaaSChatModel] = {}
+
+
+def _build_llm(model_id: str):
+    settings = get_settings()
     if model_id == "gpt":
         return AzureMaaSChatModel("gpt", settings.AZURE_OPENAI_ENDPOINT, settings.AZURE_OPENAI_KEY,
                                   settings.AZURE_OPENAI_DEPLOYMENT)
@@ -187,7 +348,15 @@ def get_llm(model_id: str):
         raise ValueError(f"Unknown model ID: {model_id}")
 
 
+def get_llm(model_id: str):
+    llm = _LLM_CACHE.get(model_id)
+    if llm is None:
+        llm = _LLM_CACHE.setdefault(model_id, _build_llm(model_id))
+    return llm
+
+
 def get_embeddings():
+    settings = get_settings()
     return AzureMaaSEmbeddings(
         endpoint=settings.EMBEDDING_ENDPOINT,
         key=settings.EMBEDDING_KEY,
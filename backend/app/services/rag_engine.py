@@ -1,17 +1,23 @@
 import os
+import re
 import logging
-import json
+import time
+import orjson
 import asyncio
+from collections import OrderedDict
+import faiss
+import numpy as np
 from langchain_community.vectorstores import FAISS
 from langchain_community.tools import DuckDuckGoSearchRun
 from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
+from app.config import get_settings
 from app.services.azure_client_factory import get_llm, get_embeddings
 
-# Setup Logging
-logging.basicConfig(level=logging.INFO)
+# Setup Logging (handlers are installed once by app.main)
 logger = logging.getLogger(__name__)
 logging.getLogger("langchain_core.vectorstores.base").setLevel(logging.ERROR)
 
@@ -26,140 +32,441 @@ DB_FOLDER = "faiss_index"
 DB_NAME = "twinings_index"
 
 
-def get_local_retriever():
+# Local similarity search: top-k and minimum relevance score
+LOCAL_K = 2
+LOCAL_SCORE_THRESHOLD = 0.6
+
+_VECTORSTORE = None
+_FAISS_INDEX = None
+_store_loaded = False
+_store_lock = asyncio.Lock()
+
+
+def _load_local_store():
     if os.path.exists(DB_FOLDER):
         try:
-            vectorstore = FAISS.load_local(
+            return FAISS.load_local(
                 DB_FOLDER,
                 embeddings,
                 index_name=DB_NAME,
                 allow_dangerous_deserialization=True
             )
-            # High threshold to drop garbage matches
-            return vectorstore.as_retriever(
-                search_type="similarity_score_threshold",
-                search_kwargs={"score_threshold": 0.6, "k": 2}
-            )
         except Exception:
             return None
     return None
 
 
+async def get_local_store():
+    """Loads the FAISS index from disk and, once loaded, reuses it for every request."""
+    global _VECTORSTORE, _FAISS_INDEX, _store_loaded
+
+    if _store_loaded:
+        return _VECTORSTORE
+
+    async with _store_lock:
+        if not _store_loaded:
+            _VECTORSTORE = await asyncio.to_thread(_load_local_store)
+            _FAISS_INDEX = _VECTORSTORE.index if _VECTORSTORE else None
+            # A missing or unreadable index is retried on the next request, so one
+            # built while the server is running is still picked up
+            _store_loaded = _VECTORSTORE is not None
+    return _VECTORSTORE
+
+
+# --- 1b. Semantic Cache ---
+
+# Pre-allocated float16 slots (halves memory traffic of the similarity sweep);
+# slot i lines up with _cache_entries[i] = [answer, inserted_at, last_hit, model_id]
+_cache_vectors = None
+_cache_entries: list[list] = []
+_cache_lock = asyncio.Lock()
+_CACHE_BLOCK_ROWS = 256
+
+
+def _unit_rows(vectors) -> np.ndarray:
+    """L2-normalises each row once so similarity is a plain inner product."""
+    arr = np.asarray(vectors, dtype=np.float32)
+    arr /= np.linalg.norm(arr, axis=-1, keepdims=True) + 1e-9
+    return arr
+
+
+def _normalize(vec: list[float]) -> np.ndarray:
+    return _unit_rows([vec])
+
+
+def _cache_scores(query_vec: np.ndarray) -> np.ndarray:
+    """Inner products against every filled slot, upcast to fp32 one block at a time."""
+    q = query_vec[0]
+    count = len(_cache_entries)
+    scores = np.empty(count, dtype=np.float32)
+    for start in range(0, count, _CACHE_BLOCK_ROWS):
+        stop = min(start + _CACHE_BLOCK_ROWS, count)
+        scores[start:stop] = _cache_vectors[start:stop].astype(np.float32) @ q
+    return scores
+
+
+def _expire_cache_slot(idx: int):
+    # Zeroed rows can never clear the threshold; -inf makes the slot reused first
+    _cache_vectors[idx] = 0
+    _cache_entries[idx][2] = float("-inf")
+
+
+async def lookup_cached_answer(query_vec: np.ndarray, model_id: str):
+    """
+    Returns a previously generated answer when a semantically equivalent
+    query (cosine >= threshold) was answered by the same model within the TTL.
+    """
+    settings = get_settings()
+    async with _cache_lock:
+        if not _cache_entries:
+            return None
+
+        scores = _cache_scores(query_vec)
+        # Answers from another model never count as hits
+        same_model = np.fromiter((e[3] == model_id for e in _cache_entries), dtype=bool, count=len(scores))
+        scores[~same_model] = -np.inf
+        idx = int(np.argmax(scores))
+        if scores[idx] < settings.CACHE_SIMILARITY_THRESHOLD:
+            return None
+
+        entry = _cache_entries[idx]
+        now = time.monotonic()
+        if now - entry[1] > settings.CACHE_TTL_SECONDS:
+            _expire_cache_slot(idx)
+            return None
+
+        entry[2] = now
+        return entry[0]
+
+
+async def store_cached_answer(query_vec: np.ndarray, answer: str, model_id: str):
+    global _cache_vectors
+
+    settings = get_settings()
+    async with _cache_lock:
+        if _cache_vectors is None:
+            _cache_vectors = np.zeros((settings.CACHE_MAX_ENTRIES, query_vec.shape[1]), dtype=np.float16)
+
+        now = time.monotonic()
+        if len(_cache_entries) < len(_cache_vectors):
+            slot = len(_cache_entries)
+            _cache_entries.append([answer, now, now, model_id])
+        else:
+            # LRU eviction
+            slot = min(range(len(_cache_entries)), key=lambda i: _cache_entries[i][2])
+            _cache_entries[slot] = [answer, now, now, model_id]
+        _cache_vectors[slot] = query_vec[0]
+
+
 # --- 2. Combined Supervisor (Speed Boost) ---
 
+# Exact-match plan cache: (query, model_id) -> (plan, stored_at)
+_PLAN_CACHE: OrderedDict[tuple[str, str], tuple[dict, float]] = OrderedDict()
+_PLAN_CACHE_TTL = 600
+_PLAN_CACHE_MAX = 512
+# key -> [lock, callers currently holding or waiting on it]
+_plan_locks: dict[tuple[str, str], list] = {}
+
+
+def _get_cached_plan(key: tuple[str, str]):
+    entry = _PLAN_CACHE.get(key)
+    if entry is None:
+        return None
+    plan, stored_at = entry
+    if time.monotonic() - stored_at > _PLAN_CACHE_TTL:
+        del _PLAN_CACHE[key]
+        return None
+    _PLAN_CACHE.move_to_end(key)
+    return plan
+
+
+# Topic words that keep an entity-free query (e.g. "Who is the CEO?") on the supervisor path
+_DOMAIN_TERMS_RE = re.compile(
+    r"\b(?:teas?|ceo|chair\w*|found\w*|history|heritage|brand\w*|compan\w*|business\w*|"
+    r"products?|drinks?|malt\w*|blend\w*|earl grey|strand|royal|warrant|executives?|directors?|"
+    r"board|sharehold\w*|acqui\w*|owne\w*|parent|subsidiar\w*|revenue|profit\w*|report\w*|"
+    r"legal|lawsuit\w*|sustainab\w*)\b",
+    re.IGNORECASE
+)
+
+
+def _is_obviously_off_topic(query: str) -> bool:
+    return (
+        len(query) < 80
+        and _KW_RE.search(query) is None
+        and _DOMAIN_TERMS_RE.search(query) is None
+    )
+
+
 async def plan_search_and_validate(query: str, model_id: str):
+    """
+    Returns the supervisor plan, reusing it for exact repeats of the same
+    query. Concurrent misses on one key share a single LLM call.
+    """
+    if get_settings().GUARDRAIL_PRECHECK and _is_obviously_off_topic(query):
+        return {"relevant": False, "reason": "no entity mention"}
+
+    key = (query, model_id)
+    plan = _get_cached_plan(key)
+    if plan is not None:
+        return plan
+
+    entry = _plan_locks.get(key)
+    if entry is None:
+        entry = _plan_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            plan = _get_cached_plan(key)
+            if plan is None:
+                plan, ok = await _run_supervisor(query, model_id)
+                if ok:
+                    _PLAN_CACHE[key] = (plan, time.monotonic())
+                    while len(_PLAN_CACHE) > _PLAN_CACHE_MAX:
+                        _PLAN_CACHE.popitem(last=False)
+    finally:
+        # Unregister only once nobody holds or waits on this lock; dropping it earlier
+        # lets a later arrival make a second lock and run the supervisor side by side
+        entry[1] -= 1
+        if entry[1] == 0 and _plan_locks.get(key) is entry:
+            del _plan_locks[key]
+    return plan
+
+
+# Markdown code fences some models wrap around the JSON plan
+_FENCE_RE = re.compile(r"^\s*```(?:json)?|```\s*$", re.MULTILINE)
+
+
+_SUPERVISOR_PROMPT = ChatPromptTemplate.from_template(
+    """You are the Supervisor for the 'Twinings Ovaltine' Intelligence Unit.
+
+    User Query: "{query}"
+
+    **Task 1: Relevance Check**
+    Is this query related to:
+    - Twinings or Ovaltine brands?
+    - Their parent companies (Associated British Foods / ABF, Wander AG)?
+    - Their executives, history, legal issues, or business operations?
+
+    **Task 2: Execution Plan**
+    If YES: Generate 2 specific search queries to find the answer. Include "Twinings Ovaltine" or "ABF" in the queries to ensure precision.
+    If NO: Return relevant=false.
+
+    **Task 3: Direct Answer**
+    Only if the query needs NO factual lookup (e.g. a greeting, a question about what you can help with, or a request to rephrase),
+    set needs_search=false and put a short reply in direct_answer. Otherwise set needs_search=true and direct_answer=null.
+    Never answer factual questions about the companies here.
+
+    **Output Format (JSON ONLY):**
+    {{
+        "relevant": true,
+        "needs_search": true,
+        "queries": ["query 1", "query 2"],
+        "direct_answer": null
+    }}
+    OR
+    {{
+        "relevant": true,
+        "needs_search": false,
+        "queries": [],
+        "direct_answer": "Short reply"
+    }}
+    OR
+    {{
+        "relevant": false,
+        "reason": "Off-topic"
+    }}
+    """
+)
+
+
+async def _run_supervisor(query: str, model_id: str):
     """
     Combines Guardrail Check AND Search Planning into ONE LLM call
-    to reduce latency.
+    to reduce latency. Returns (plan, ok); fail-safe plans are not cached.
     """
     llm = get_llm(model_id)
 
-    supervisor_prompt = ChatPromptTemplate.from_template(
-        """You are the Supervisor for the 'Twinings Ovaltine' Intelligence Unit.
-
-        User Query: "{query}"
-
-        **Task 1: Relevance Check**
-        Is this query related to:
-        - Twinings or Ovaltine brands?
-        - Their parent companies (Associated British Foods / ABF, Wander AG)?
-        - Their executives, history, legal issues, or business operations?
-
-        **Task 2: Execution Plan**
-        If YES: Generate 2 specific search queries to find the answer. Include "Twinings Ovaltine" or "ABF" in the queries to ensure precision.
-        If NO: Return relevant=false.
-
-        **Output Format (JSON ONLY):**
-        {{
-            "relevant": true,
-            "queries": ["query 1", "query 2"]
-        }}
-        OR
-        {{
-            "relevant": false,
-            "reason": "Off-topic"
-        }}
-        """
-    )
-
-    chain = supervisor_prompt | llm | StrOutputParser()
+    chain = _SUPERVISOR_PROMPT | llm | StrOutputParser()
     try:
         result = await chain.ainvoke({"query": query})
-        cleaned = result.replace("```json", "").replace("```", "").strip()
-        return json.loads(cleaned)
+        cleaned = _FENCE_RE.sub("", result).strip()
+        return orjson.loads(cleaned), True
     except Exception as e:
         logger.error(f"Supervisor Error: {e}")
         # Fail-safe: assume relevant if LLM breaks, generic query
-        return {"relevant": True, "queries": [f"Twinings Ovaltine {query}"]}
+        return {"relevant": True, "needs_search": True, "queries": [f"Twinings Ovaltine {query}"]}, False
 
 
 # --- 3. Strict Content Filtering (Output Guardrail) ---
 
-def filter_irrelevant_content(results: list[str]) -> str:
+# Expanded list of valid entities, compiled into a single case-insensitive scan
+_KW_RE = re.compile(
+    r"twining|ovaltine|abf|associated british foods|wander ag|r\. twining|stephen twining",
+    re.IGNORECASE
+)
+
+
+def filter_irrelevant_content(results: list[str]) -> list[str]:
     """
     Hard Guardrail: Discards search results that don't explicitly mention
     our target entities. This prevents "generic tea info" pollution.
     """
-    # Expanded list of valid entities
-    valid_keywords = [
-        "twining", "ovaltine", "abf", "associated british foods",
-        "wander ag", "r. twining", "stephen twining"
-    ]
-
     filtered_text = []
     seen = set()
 
     for res in results:
         # 1. Dedup
-        h = hash(res[:50])
-        if h in seen: continue
-        seen.add(h)
+        key = res[:50]
+        if key in seen: continue
+        seen.add(key)
 
         # 2. Keyword Check
-        if any(k in res.lower() for k in valid_keywords):
+        if _KW_RE.search(res):
             filtered_text.append(res)
         else:
             logger.info(f"Dropped irrelevant snippet: {res[:50]}...")
 
-    return "\n\n".join(filtered_text)
+    return filtered_text
+
+
+# --- 3b. Snippet Reranking ---
+
+RERANK_TOP_K = 5
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_snippets(results: list[str]) -> list[str]:
+    """Breaks search results into unique sentence-level snippets."""
+    # Both supervisor queries often return the same page; a repeated sentence must not fill several rerank slots
+    return list(dict.fromkeys(s.strip() for res in results for s in _SENTENCE_RE.split(res) if s.strip()))
+
+
+async def rerank_snippets(query: str, snippets: list[str], top_k: int = RERANK_TOP_K,
+                          query_embedding=None) -> list[str]:
+    """
+    Keeps the top_k snippets by cosine similarity to the query, embedding
+    everything in one batched call. A cross-encoder (e.g. ms-marco-MiniLM)
+    can replace the scoring here without changing the signature.
+    """
+    if len(snippets) <= top_k:
+        return snippets
+
+    try:
+        if query_embedding is None:
+            vectors = await embeddings.aembed_batch([query] + snippets)
+            query_embedding, snippet_vectors = vectors[0], vectors[1:]
+        else:
+            snippet_vectors = await embeddings.aembed_batch(snippets)
+    except Exception as e:
+        logger.error(f"Rerank embedding failed: {e}")
+        return snippets
+
+    scores = _unit_rows(snippet_vectors) @ _normalize(query_embedding)[0]
+    top = np.argsort(-scores)[:top_k]
+    return [snippets[i] for i in top]
 
 
 # --- 4. Deep Context Fetcher ---
 
+# Search string -> (results, stored_at)
+_SEARCH_CACHE: OrderedDict[str, tuple[str, float]] = OrderedDict()
+_SEARCH_CACHE_TTL = 600
+_SEARCH_CACHE_MAX = 1000
+
+
 async def execute_search(query: str):
-    """Async wrapper for the sync tool"""
+    """Async wrapper for the sync tool, memoised per search string"""
+    entry = _SEARCH_CACHE.get(query)
+    if entry is not None:
+        if time.monotonic() - entry[1] <= _SEARCH_CACHE_TTL:
+            _SEARCH_CACHE.move_to_end(query)
+            return entry[0]
+        del _SEARCH_CACHE[query]
+
     try:
         # Add timeout to prevent hanging
-        return await asyncio.to_thread(web_search_tool.invoke, query)
+        result = await asyncio.to_thread(web_search_tool.invoke, query)
     except Exception as e:
         logger.error(f"Search failed: {e}")
         return ""
 
+    if result:
+        _SEARCH_CACHE[query] = (result, time.monotonic())
+        while len(_SEARCH_CACHE) > _SEARCH_CACHE_MAX:
+            _SEARCH_CACHE.popitem(last=False)
+    return result
+
+
+async def _local_retrieve(query: str, query_embedding=None):
+    """
+    Local FAISS lookup; depends only on the query, not on the plan.
+    Searches the raw index and applies the relevance threshold in NumPy,
+    bypassing the LangChain retriever wrapper.
+    """
+    store = await get_local_store()
+    if store is None:
+        return []
+    try:
+        if query_embedding is None:
+            query_embedding = await embeddings.aembed_query(query)
+        vec = np.asarray([query_embedding], dtype=np.float32)
+        is_cosine = _FAISS_INDEX.metric_type == faiss.METRIC_INNER_PRODUCT
+        # Inner-product indexes are built over normalised vectors (cosine)
+        if is_cosine:
+            faiss.normalize_L2(vec)
+
+        distances, ids = _FAISS_INDEX.search(vec, LOCAL_K)
+        if is_cosine:
+            # Squared L2 between unit vectors is 2 - 2cos; rewriting it that way keeps
+            # LOCAL_SCORE_THRESHOLD on the scale it was tuned on (0.6 here ~ cosine 0.72)
+            scores = 1.0 - (2.0 - 2.0 * distances[0]) / np.sqrt(2)
+        else:
+            # Same mapping LangChain applies to L2 distances
+            scores = 1.0 - distances[0] / np.sqrt(2)
+
+        # High threshold to drop garbage matches
+        hits = ids[0][(ids[0] >= 0) & (scores >= LOCAL_SCORE_THRESHOLD)]
+        docs = [store.docstore.search(store.index_to_docstore_id[int(i)]) for i in hits]
+        return _expand_to_parents(store, [doc for doc in docs if isinstance(doc, Document)])
+    except Exception:
+        return []
+
+
+def _expand_to_parents(store, docs):
+    """Small-to-big: swap each matched chunk for its parent passage, once per parent."""
+    expanded = {}
+    for doc in docs:
+        parent_id = doc.metadata.get("parent_id")
+        parent = store.docstore.search(parent_id) if parent_id else None
+        if isinstance(parent, Document):
+            expanded.setdefault(parent_id, parent)
+        else:
+            # Chunks indexed before parents existed are returned as-is
+            expanded.setdefault(id(doc), doc)
+    return list(expanded.values())
+
 
-async def fetch_validated_context(plan, query):
+async def fetch_validated_context(plan, query, local_docs=None, query_embedding=None):
     if not plan.get("relevant", False):
         return None
 
     # Parallel Search
-    search_queries = plan.get("queries", [])[:2]  # Limit to 2 for speed
+    search_queries = list(dict.fromkeys(plan.get("queries", [])))[:2]  # Dedup, limit to 2 for speed
     logger.info(f"Executing Searches: {search_queries}")
 
     tasks = [execute_search(q) for q in search_queries]
     raw_results = await asyncio.gather(*tasks)
 
-    # Filter Results
-    clean_web_context = filter_irrelevant_content(raw_results)
+    # Filter, then keep only the snippets closest to the query
+    snippets = split_snippets(filter_irrelevant_content(raw_results))
+    top_snippets = await rerank_snippets(query, snippets, query_embedding=query_embedding)
+    clean_web_context = "\n\n".join(top_snippets)
 
-    # Local DB (Optional)
+    # Local DB (Optional, retrieved alongside the supervisor call)
     local_context = ""
-    retriever = get_local_retriever()
-    if retriever:
-        try:
-            docs = await retriever.ainvoke(query)
-            if docs:
-                local_context = "\n".join([doc.page_content for doc in docs])
-        except Exception:
-            pass
+    if local_docs:
+        local_context = "\n".join([doc.page_content for doc in local_docs])
 
     # Final Assembly
     full_context = ""
@@ -191,25 +498,94 @@ prompt = ChatPromptTemplate.from_messages([
 ])
 
 
-async def generate_response(query: str, model_id: str):
-    # 1. Plan (Fast Check)
-    plan = await plan_search_and_validate(query, model_id)
+async def _prepare_generation(query: str, model_id: str):
+    """
+    Runs every step up to the final LLM call.
+    Returns (query_vec, early_answer, context_data); early_answer is set when
+    the pipeline short-circuits and no generation is needed.
+    """
+    # 0. Semantic Cache (paraphrases skip the whole pipeline)
+    query_embedding = None
+    query_vec = None
+    if get_settings().CACHE_ENABLED:
+        try:
+            query_embedding = await embeddings.aembed_query(query)
+            query_vec = _normalize(query_embedding)
+            cached = await lookup_cached_answer(query_vec, model_id)
+            if cached is not None:
+                logger.info("Semantic cache hit")
+                return query_vec, cached, None
+        except Exception as e:
+            logger.error(f"Semantic cache lookup failed: {e}")
+            query_vec = None
+
+    # 1. Plan (Fast Check), overlapped with the local retrieval
+    plan, local_docs = await asyncio.gather(
+        plan_search_and_validate(query, model_id),
+        _local_retrieve(query, query_embedding)
+    )
 
     if not plan.get("relevant"):
-        return "Beyond my scope."
+        return query_vec, "Beyond my scope.", None
+
+    # 1b. Direct Answer (no search or second LLM call needed)
+    if plan.get("needs_search") is False and plan.get("direct_answer"):
+        return query_vec, plan["direct_answer"], None
 
     # 2. Fetch & Filter (Heavy Lifting)
-    context_data = await fetch_validated_context(plan, query)
+    context_data = await fetch_validated_context(plan, query, local_docs, query_embedding)
 
     # 3. Fail Fast (Output Guardrail)
     if not context_data:
-        return "Data not found regarding this query."
+        return query_vec, "Data not found regarding this query.", None
+
+    return query_vec, None, context_data
+
+
+async def _remember_answer(query_vec, answer: str, model_id: str):
+    if query_vec is not None and not answer.startswith("Error generating response"):
+        await store_cached_answer(query_vec, answer, model_id)
+
+
+async def generate_response(query: str, model_id: str):
+    query_vec, early_answer, context_data = await _prepare_generation(query, model_id)
+    if early_answer is not None:
+        return early_answer
 
     # 4. Generate Answer
     llm = get_llm(model_id)
     chain = prompt | llm | StrOutputParser()
 
-    return await chain.ainvoke({
+    answer = await chain.ainvoke({
         "context": context_data,
         "question": query
-    })
\ No newline at end of file
+    })
+
+    await _remember_answer(query_vec, answer, model_id)
+    return answer
+
+
+async def stream_response(query: str, model_id: str):
+    """
+    Same pipeline as generate_response, but yields the final answer as it is
+    generated. Only the last LLM call streams; the supervisor stays blocking
+    so its JSON plan can be parsed in one piece.
+    """
+    query_vec, early_answer, context_data = await _prepare_generation(query, model_id)
+    if early_answer is not None:
+        yield early_answer
+        return
+
+    llm = get_llm(model_id)
+    chain = prompt | llm | StrOutputParser()
+
+    parts = []
+    async for delta in chain.astream({
+        "context": context_data,
+        "question": query
+    }):
+        if delta:
+            parts.append(delta)
+            yield delta
+
+    await _remember_answer(query_vec, "".join(parts), model_id)
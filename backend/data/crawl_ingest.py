@@ -3,22 +3,30 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import gzip
 import hashlib
-import io
-import json
 import logging
+import math
 import os
 import re
 import shutil
 import sys
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Sequence
-
-import requests
-from bs4 import BeautifulSoup
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import faiss
+import httpx
+import numpy as np
+import orjson
+import pypdfium2 as pdfium
+import xxhash
 from crawl4ai import (
     AsyncWebCrawler,
     CacheMode,
@@ -27,9 +35,13 @@ from crawl4ai import (
     LinkPreviewConfig,
 )
 from duckduckgo_search import DDGS
+from selectolax.parser import HTMLParser
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from dotenv import load_dotenv
 from azure.ai.inference import EmbeddingsClient
 from azure.core.credentials import AzureKeyCredential
@@ -48,6 +60,7 @@ RAW_DIR = DATA_DIR / "raw"
 PROCESSED_DIR = DATA_DIR / "processed"
 FAISS_DIR = ROOT_DIR / "faiss_index"
 INDEX_NAME = "index"
+MANIFEST_FILE = FAISS_DIR / "manifest.json"
 
 EMBEDDING_ENDPOINT = "https://llmaccess.services.ai.azure.com/models"
 EMBEDDING_KEY = os.getenv("EMBEDDING_KEY", "").strip()
@@ -60,30 +73,49 @@ EMBED_CLIENT = EmbeddingsClient(
 )
 
 
-class InlineAzureEmbeddings:
+class InlineAzureEmbeddings(Embeddings):
     """Minimal adapter so FAISS can request embeddings."""
 
     model_name = os.getenv("EMBEDDING_MODEL", "embed-v-4-0")
     batch_limit = int(os.getenv("EMBEDDING_BATCH_LIMIT", "90"))
 
+    concurrency = int(os.getenv("EMBED_CONCURRENCY", "8"))
+
+    @staticmethod
+    def _retry_after(exc: Exception, attempt: int) -> float:
+        headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return 2 ** attempt  # exponential backoff
+
+    @staticmethod
+    def _embed_one_batch(batch: List[str]) -> List[List[float]]:
+        for attempt in range(5):  # max retries
+            try:
+                response = EMBED_CLIENT.embed(input=batch, model=InlineAzureEmbeddings.model_name)
+                return [item.embedding for item in response.data]
+            except Exception as e:
+                if "429" in str(e) and attempt < 4:
+                    wait_time = InlineAzureEmbeddings._retry_after(e, attempt)
+                    logger.warning(f"Rate limit hit, waiting {wait_time} seconds")
+                    time.sleep(wait_time)
+                else:
+                    raise
+        return []
+
     @staticmethod
     def embed_documents(texts: List[str]) -> List[List[float]]:
-        vectors: List[List[float]] = []
         batch_size = max(1, InlineAzureEmbeddings.batch_limit)
-        for start in range(0, len(texts), batch_size):
-            batch = texts[start:start + batch_size]
-            for attempt in range(5):  # max retries
-                try:
-                    response = EMBED_CLIENT.embed(input=batch, model=InlineAzureEmbeddings.model_name)
-                    vectors.extend(item.embedding for item in response.data)
-                    break
-                except Exception as e:
-                    if "429" in str(e) and attempt < 4:
-                        wait_time = 2 ** attempt  # exponential backoff
-                        logger.warning(f"Rate limit hit, waiting {wait_time} seconds")
-                        time.sleep(wait_time)
-                    else:
-                        raise
+        batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+        if not batches:
+            return []
+        vectors: List[List[float]] = []
+        workers = max(1, min(InlineAzureEmbeddings.concurrency, len(batches)))
+        # map() yields in submission order, so vectors stay aligned with texts
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for batch_vectors in pool.map(InlineAzureEmbeddings._embed_one_batch, batches):
+                vectors.extend(batch_vectors)
         return vectors
 
     @staticmethod
@@ -109,6 +141,8 @@ ALLOWED_DOMAIN_SNIPPETS = [
     "ovaltine.",
 ]
 KEYWORD_FILTER = ["twinings", "ovaltine", "associated british", "abf", "wander"]
+_DOMAIN_RE = re.compile("|".join(map(re.escape, ALLOWED_DOMAIN_SNIPPETS)))
+_KEYWORD_RE = re.compile("|".join(map(re.escape, KEYWORD_FILTER)))
 DEFAULT_DDG_QUERIES = [
     "Twinings Ovaltine heritage",
     "Twinings shareholder report",
@@ -122,7 +156,24 @@ DEFAULT_DDG_QUERIES = [
     "Twinings stakeholder engagement pdf",
 ]
 MAX_QUEUE_SIZE = int(os.getenv("CRAWL_MAX_QUEUE", "5000"))
+CRAWL_BATCH = int(os.getenv("CRAWL_BATCH", "16"))
+# Below this many documents, process start-up costs more than the split itself
+SPLIT_PARALLEL_MIN_DOCS = int(os.getenv("SPLIT_PARALLEL_MIN_DOCS", "64"))
+# Small-to-big: children are embedded, the parent passage they came from is what gets returned
+PARENT_CHUNK_SIZE = int(os.getenv("PARENT_CHUNK_SIZE", "2500"))
+# Chunks shorter than this are tail fragments: folded into the previous chunk or dropped
+MIN_CHUNK_CHARS = int(os.getenv("MIN_CHUNK_CHARS", "120"))
+CHUNK_SLACK = 200  # how far past --chunk-size a chunk may run before it is cut
 MAX_PDF_BYTES = int(os.getenv("CRAWL_MAX_PDF_BYTES", str(8 * 1024 * 1024)))  # 8MB default
+PDF_CONCURRENCY = int(os.getenv("CRAWL_PDF_CONCURRENCY", "16"))
+# Below this many vectors an exhaustive flat scan is as fast as HNSW
+HNSW_MIN_VECTORS = int(os.getenv("FAISS_HNSW_MIN_VECTORS", "10000"))
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+PQ_M = int(os.getenv("FAISS_PQ_M", "16"))  # sub-quantizers; must divide the embedding dim
+PQ_NBITS = 8  # each sub-quantizer trains 2**PQ_NBITS centroids, so needs at least that many vectors
 RAW_BINARY_DIR = RAW_DIR / "binary"
 RAW_BINARY_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -131,19 +182,21 @@ RAW_BINARY_DIR.mkdir(parents=True, exist_ok=True)
 class RawRecord:
     url: str
     title: str
-    html: str
+    text: str  # sanitized at harvest time; the raw HTML is not kept in memory
     markdown: str
     crawled_at: str
     links: List[str]
+    raw_html_path: Optional[str] = None
 
     def to_json(self) -> Dict[str, Any]:
         return {
             "url": self.url,
             "title": self.title,
-            "html": self.html,
+            "text": self.text,
             "markdown": self.markdown,
             "crawled_at": self.crawled_at,
             "links": self.links,
+            "raw_html_path": self.raw_html_path,
         }
 
 
@@ -154,15 +207,16 @@ def ensure_dirs() -> None:
 
 
 def collapse_whitespace(text: str) -> str:
-    return re.sub(r"\s+", " ", text).strip()
+    # str.split() with no args splits on whitespace runs and drops empties, like \s+ plus strip()
+    return " ".join(text.split())
 
 
 def sanitize_text(html: str, markdown: str) -> str:
     if html:
-        soup = BeautifulSoup(html, "lxml")
-        for bad in soup.find_all(["script", "style", "noscript"]):
-            bad.decompose()
-        text = soup.get_text(" ", strip=True)
+        tree = HTMLParser(html)
+        tree.strip_tags(["script", "style", "noscript"])
+        node = tree.body or tree.root
+        text = node.text(separator=" ") if node else ""
     else:
         text = markdown
     return collapse_whitespace(text)
@@ -188,103 +242,158 @@ def extract_links(link_blob: Any) -> List[str]:
     return links
 
 
+@lru_cache(maxsize=65536)
 def is_allowed_url(url: str) -> bool:
+    """Called for every discovered link; the same URLs recur across pages."""
     if not url.startswith("http"):
         return False
     lower = url.lower()
-    return any(s in lower for s in ALLOWED_DOMAIN_SNIPPETS) and any(k in lower for k in KEYWORD_FILTER)
+    return _DOMAIN_RE.search(lower) is not None and _KEYWORD_RE.search(lower) is not None
 
 
-def next_links(links: Sequence[str], seen: set[str], limit: int) -> List[str]:
+def next_links(links: Sequence[str], seen: set[str], queued: set[str], limit: int) -> List[str]:
     stack: List[str] = []
     for link in links:
         if len(stack) >= limit:
             break
-        if link in seen:
+        if link in seen or link in queued:
             continue
         if is_allowed_url(link):
             stack.append(link)
+            queued.add(link)
     return stack
 
 
-async def crawl(seed_urls: Sequence[str], max_pages: int, per_page_limit: int) -> List[RawRecord]:
-    queue = list(dict.fromkeys(seed_urls))
-    seen: set[str] = set()
-    harvested: List[RawRecord] = []
+def save_raw_html(url: str, html: str) -> str:
+    path = RAW_BINARY_DIR / f"{hash_text(url)}.html.gz"
+    with gzip.open(path, "wb", compresslevel=3) as fh:
+        fh.write(html.encode("utf-8", errors="ignore"))
+    return str(path)
 
-    async with AsyncWebCrawler() as crawler:
-        while queue and len(harvested) < max_pages:
-            url = queue.pop(0)
-            if url in seen:
-                continue
-            seen.add(url)
-            logger.info("Crawling %s", url)
-
-            config = CrawlerRunConfig(
-                link_preview_config=LinkPreviewConfig(
-                    include_internal=True,
-                    include_external=False,
-                    max_links=20,
-                    concurrency=3,
-                    timeout=20,
-                    query="Twinings Ovaltine heritage",
-                ),
-                cache_mode=CacheMode.ENABLED,
-                screenshot=False,
-                markdown_generator=DefaultMarkdownGenerator(),
-                check_robots_txt=True,
-            )
 
-            try:
-                run = await crawler.arun(url=url, config=config)
-            except Exception as exc:  # noqa: BLE001
-                logger.warning("Error crawling %s: %s", url, exc)
-                continue
+def build_record(url: str, result: Any, keep_html: bool = False) -> RawRecord:
+    html = getattr(result, "html", "") or ""
+    markdown = ""
+    if hasattr(result, "markdown") and result.markdown:
+        markdown = getattr(result.markdown, "raw_markdown", str(result.markdown)) or ""
 
-            result = getattr(run, "_results", [run])[0]
-            html = getattr(result, "html", "") or ""
-            markdown = ""
-            if hasattr(result, "markdown") and result.markdown:
-                markdown = getattr(result.markdown, "raw_markdown", str(result.markdown)) or ""
-
-            meta = getattr(result, "metadata", {}) or {}
-            title = meta.get("title") or meta.get("page_title") or "Unknown"
-            links = extract_links(getattr(result, "links", None))
-
-            harvested.append(
-                RawRecord(
-                    url=url,
-                    title=title,
-                    html=html,
-                    markdown=markdown,
-                    crawled_at=datetime.utcnow().isoformat(),
-                    links=links,
-                )
-            )
+    meta = getattr(result, "metadata", {}) or {}
+    title = meta.get("title") or meta.get("page_title") or "Unknown"
+    links = extract_links(getattr(result, "links", None))
 
-            queue.extend(next_links(links, seen.union(queue), per_page_limit))
+    return RawRecord(
+        url=url,
+        title=title,
+        text=sanitize_text(html, markdown),
+        markdown=markdown,
+        crawled_at=datetime.utcnow().isoformat(),
+        links=links,
+        raw_html_path=save_raw_html(url, html) if keep_html and html else None,
+    )
 
-            if len(harvested) >= max_pages:
+
+async def write_records(records: asyncio.Queue, out_path: Path) -> None:
+    """Drain crawled records to JSONL as they arrive; None marks the end of the crawl."""
+    with out_path.open("wb") as fh:
+        while True:
+            record = await records.get()
+            if record is None:
                 break
+            fh.write(orjson.dumps(record.to_json()) + b"\n")
+
+
+async def crawl(
+    seed_urls: Sequence[str],
+    out_path: Path,
+    max_pages: int,
+    per_page_limit: int,
+    keep_html: bool = False,
+) -> int:
+    """Crawl from the seeds, streaming each record to out_path; returns the page count."""
+    queue = deque(dict.fromkeys(seed_urls))
+    queued: set[str] = set(queue)
+    seen: set[str] = set()
+    harvested = 0
+    records: asyncio.Queue = asyncio.Queue(maxsize=CRAWL_BATCH * 2)
+    writer = asyncio.create_task(write_records(records, out_path))
+
+    config = CrawlerRunConfig(
+        link_preview_config=LinkPreviewConfig(
+            include_internal=True,
+            include_external=False,
+            max_links=20,
+            concurrency=3,
+            timeout=20,
+            query="Twinings Ovaltine heritage",
+        ),
+        cache_mode=CacheMode.ENABLED,
+        screenshot=False,
+        markdown_generator=DefaultMarkdownGenerator(),
+        check_robots_txt=True,
+    )
+
+    try:
+        async with AsyncWebCrawler() as crawler:
+            while queue and harvested < max_pages:
+                batch: List[str] = []
+                batch_limit = min(CRAWL_BATCH, max_pages - harvested)
+                while queue and len(batch) < batch_limit:
+                    url = queue.popleft()
+                    if url in seen:
+                        continue
+                    seen.add(url)
+                    batch.append(url)
+                if not batch:
+                    break
+                logger.info("Crawling batch of %d: %s", len(batch), ", ".join(batch))
 
-    logger.info("Crawled %d pages", len(harvested))
+                try:
+                    results = await crawler.arun_many(urls=batch, config=config)
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Error crawling batch starting %s: %s", batch[0], exc)
+                    continue
+
+                for run in results:
+                    result = getattr(run, "_results", [run])[0]
+                    url = getattr(result, "url", None)
+                    if not url:
+                        continue
+                    if not getattr(result, "success", True):
+                        logger.warning("Error crawling %s: %s", url, getattr(result, "error_message", ""))
+                        continue
+
+                    record = build_record(url, result, keep_html)
+                    await records.put(record)
+                    harvested += 1
+                    queue.extend(next_links(record.links, seen, queued, per_page_limit))
+
+                    if harvested >= max_pages:
+                        break
+    finally:
+        # Also runs on timeout, so everything crawled so far is on disk before it is read back
+        await records.put(None)
+        await writer
+
+    logger.info("Crawled %d pages", harvested)
     return harvested
 
 
 def write_jsonl(path: Path, rows: Iterable[Dict[str, Any]]) -> None:
-    with path.open("w", encoding="utf-8") as fh:
+    # orjson emits UTF-8 bytes directly (no ASCII escaping), straight into the buffered writer
+    with path.open("wb") as fh:
         for row in rows:
-            fh.write(json.dumps(row, ensure_ascii=False) + "\n")
+            fh.write(orjson.dumps(row) + b"\n")
 
 
-def clean(raw: Sequence[RawRecord]) -> List[Dict[str, Any]]:
+def clean(raw: Iterable[RawRecord]) -> List[Dict[str, Any]]:
     cleaned: List[Dict[str, Any]] = []
-    seen_hashes: set[str] = set()
+    seen_hashes: set[int] = set()
     for record in raw:
-        text = sanitize_text(record.html, record.markdown)
+        text = record.text
         if not text:
             continue
-        fingerprint = hash(text[:500])
+        # Stable across runs (unlike hash()) and covers the whole page, not just a shared header
+        fingerprint = xxhash.xxh3_64_intdigest(text.encode("utf-8", errors="ignore"))
         if fingerprint in seen_hashes:
             continue
         seen_hashes.add(fingerprint)
@@ -300,31 +409,175 @@ def clean(raw: Sequence[RawRecord]) -> List[Dict[str, Any]]:
     return cleaned
 
 
-def chunk_docs(docs: Sequence[Dict[str, Any]], run_id: str, chunk: int, overlap: int) -> List[Document]:
-    splitter = RecursiveCharacterTextSplitter(
+class OffsetTextSplitter(RecursiveCharacterTextSplitter):
+    """
+    Same chunks as RecursiveCharacterTextSplitter, but works on (start, end)
+    offsets into the source text: separators are located with str.find, merge
+    lengths come from offset arithmetic and each chunk is sliced exactly once.
+    """
+
+    def _split_text(self, text: str, separators: List[str]) -> List[str]:
+        # The offset shortcut only holds for len-based sizing with separators kept on the next piece
+        if (
+            self._length_function is not len
+            or self._is_separator_regex
+            or self._keep_separator not in (True, "start")
+        ):
+            return super()._split_text(text, separators)
+        return self._split_span(text, 0, len(text), separators)
+
+    def _split_span(self, text: str, start: int, end: int, separators: List[str]) -> List[str]:
+        separator = separators[-1]
+        remaining: List[str] = []
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if text.find(candidate, start, end) != -1:
+                separator = candidate
+                remaining = separators[i + 1:]
+                break
+
+        chunks: List[str] = []
+        good: List[Tuple[int, int]] = []
+        for span in self._separator_spans(text, start, end, separator):
+            if span[1] - span[0] < self._chunk_size:
+                good.append(span)
+                continue
+            if good:
+                chunks.extend(self._merge_spans(text, good))
+                good = []
+            if remaining:
+                chunks.extend(self._split_span(text, span[0], span[1], remaining))
+            else:
+                chunks.append(text[span[0]:span[1]])
+        if good:
+            chunks.extend(self._merge_spans(text, good))
+        return chunks
+
+    @staticmethod
+    def _separator_spans(text: str, start: int, end: int, separator: str) -> List[Tuple[int, int]]:
+        if not separator:
+            return [(i, i + 1) for i in range(start, end)]
+        spans: List[Tuple[int, int]] = []
+        prev = start
+        pos = text.find(separator, start, end)
+        while pos != -1:
+            if pos > prev:
+                spans.append((prev, pos))
+            prev = pos
+            pos = text.find(separator, pos + len(separator), end)
+        if end > prev:
+            spans.append((prev, end))
+        return spans
+
+    def _merge_spans(self, text: str, spans: List[Tuple[int, int]]) -> List[str]:
+        # Spans are contiguous, so a window of them is one slice of the source text
+        docs: List[str] = []
+        window: deque[Tuple[int, int]] = deque()
+        total = 0
+        for span_start, span_end in spans:
+            size = span_end - span_start
+            if window and total + size > self._chunk_size:
+                doc = text[window[0][0]:window[-1][1]].strip()
+                if doc:
+                    docs.append(doc)
+                while total > self._chunk_overlap or (total + size > self._chunk_size and total > 0):
+                    head_start, head_end = window.popleft()
+                    total -= head_end - head_start
+            window.append((span_start, span_end))
+            total += size
+        if window:
+            doc = text[window[0][0]:window[-1][1]].strip()
+            if doc:
+                docs.append(doc)
+        return docs
+
+
+@lru_cache(maxsize=None)
+def get_splitter(chunk: int, overlap: int) -> RecursiveCharacterTextSplitter:
+    return OffsetTextSplitter(
         chunk_size=chunk,
         chunk_overlap=overlap,
         separators=["\n\n", "\n", ". ", " "]
     )
+
+
+def cut_evenly(text: str, max_size: int) -> List[str]:
+    """Hard-cuts text into equal pieces of at most max_size, so the tail is not a stray fragment."""
+    size = math.ceil(len(text) / math.ceil(len(text) / max_size))
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+def normalize_splits(splits: Sequence[str], max_size: int, min_size: int = MIN_CHUNK_CHARS) -> List[str]:
+    """Cut oversized chunks, fold tiny ones into their predecessor (or drop them), dedupe."""
+    normalized: List[str] = []
+    for split in splits:
+        # Only separator-free runs get past the splitter, so a hard cut is all that is left
+        pieces = cut_evenly(split, max_size) if len(split) > max_size else [split]
+        for piece in pieces:
+            if len(piece) >= min_size:
+                normalized.append(piece)
+            elif normalized and len(normalized[-1]) + 1 + len(piece) <= max_size:
+                normalized[-1] = f"{normalized[-1]} {piece}"
+    return list(dict.fromkeys(normalized))
+
+
+def split_one(job: Tuple[str, int, int, int]) -> List[Tuple[str, List[str]]]:
+    """
+    Top-level so worker processes can unpickle it; one splitter per process.
+    Returns (parent, children) pairs; with parent_chunk <= 0 each child is its own parent.
+    """
+    content, chunk, overlap, parent_chunk = job
+    splitter = get_splitter(chunk, overlap)
+    max_size = chunk + CHUNK_SLACK
+    if parent_chunk <= 0:
+        return [(split, [split]) for split in normalize_splits(splitter.split_text(content), max_size)]
+    families = (
+        (parent, normalize_splits(splitter.split_text(parent), max_size))
+        for parent in get_splitter(parent_chunk, 0).split_text(content)
+    )
+    # A parent whose only text was a dropped fragment would never be reached
+    return [(parent, children) for parent, children in families if children]
+
+
+def chunk_docs(
+    docs: Sequence[Dict[str, Any]], run_id: str, chunk: int, overlap: int, parent_chunk: int = PARENT_CHUNK_SIZE
+) -> Tuple[List[Document], Dict[str, Document]]:
+    """Returns the child chunks to embed and the parent passages (by id) to keep in the docstore only."""
+    jobs = [(doc["content"], chunk, overlap, parent_chunk) for doc in docs]
+    if len(jobs) < SPLIT_PARALLEL_MIN_DOCS:
+        all_splits = [split_one(job) for job in jobs]
+    else:
+        # Splitting is CPU-bound and independent per document
+        with ProcessPoolExecutor() as pool:
+            all_splits = list(pool.map(split_one, jobs, chunksize=8))
+
     pieces: List[Document] = []
-    for doc in docs:
-        splits = splitter.split_text(doc["content"])
-        for idx, split in enumerate(splits):
-            pieces.append(
-                Document(
-                    page_content=split,
-                    metadata={
-                        "source": doc["url"],
-                        "title": doc["title"],
-                        "run_id": run_id,
-                        "chunk_index": idx,
-                        "chunks_total": len(splits),
-                        "crawled_at": doc["crawled_at"],
-                    },
-                )
+    parents: Dict[str, Document] = {}
+    for doc, families in zip(docs, all_splits):
+        base = {
+            "source": doc["url"],
+            "title": doc["title"],
+            "run_id": run_id,
+            "crawled_at": doc["crawled_at"],
+        }
+        child_base = {**base, "chunks_total": sum(len(children) for _, children in families)}
+        idx = 0
+        for parent, children in families:
+            child_meta = child_base
+            if parent_chunk > 0:
+                # Content-addressed, so re-ingesting a page reuses the stored parent
+                parent_id = content_hash(parent)
+                parents.setdefault(parent_id, Document(page_content=parent, metadata=base))
+                child_meta = {**child_base, "parent_id": parent_id}
+            pieces.extend(
+                Document(page_content=split, metadata={**child_meta, "chunk_index": idx + offset})
+                for offset, split in enumerate(children)
             )
-    logger.info("Built %d chunks", len(pieces))
-    return pieces
+            idx += len(children)
+    logger.info("Built %d chunks under %d parents", len(pieces), len(parents))
+    return pieces, parents
 
 
 def serialize_docs(path: Path, docs: Sequence[Document]) -> None:
@@ -344,11 +597,148 @@ def backup_index(stamp: str) -> Optional[Path]:
         shutil.copy2(faiss_file, target / faiss_file.name)
     if meta_file.exists():
         shutil.copy2(meta_file, target / meta_file.name)
+    if MANIFEST_FILE.exists():
+        shutil.copy2(MANIFEST_FILE, target / MANIFEST_FILE.name)
     logger.info("Backed up FAISS index to %s", target)
     return target
 
 
-def rebuild_index(documents: Sequence[Document], stamp: str) -> None:
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8", errors="ignore")).hexdigest()
+
+
+def unique_documents(documents: Iterable[Document]) -> List[Document]:
+    unique: Dict[str, Document] = {}
+    for doc in documents:
+        unique.setdefault(content_hash(doc.page_content), doc)
+    return list(unique.values())
+
+
+def load_manifest(store: FAISS) -> Dict[str, str]:
+    """Maps sha1(page_content) to docstore id for every chunk already indexed."""
+    if MANIFEST_FILE.exists():
+        return orjson.loads(MANIFEST_FILE.read_bytes())
+    # Index predates the manifest: derive it once from the embedded entries (parents are not embedded)
+    return {
+        content_hash(store.docstore._dict[doc_id].page_content): doc_id
+        for doc_id in store.index_to_docstore_id.values()
+    }
+
+
+def add_parents(store: FAISS, parents: Dict[str, Document]) -> None:
+    """Parents live in the docstore only; no index row points at them."""
+    new_parents = {pid: doc for pid, doc in parents.items() if pid not in store.docstore._dict}
+    if new_parents:
+        store.docstore.add(new_parents)
+    logger.info("Stored %d new parent passages", len(new_parents))
+
+
+def save_manifest(manifest: Dict[str, str]) -> None:
+    MANIFEST_FILE.write_bytes(orjson.dumps(manifest))
+
+
+def build_faiss_index(dim: int, count: int, index_type: str = "auto") -> faiss.Index:
+    if index_type == "auto":
+        index_type = "flat" if count < HNSW_MIN_VECTORS else "hnsw"
+
+    # Inner product over L2-normalised vectors == cosine similarity
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    if index_type == "ivf":
+        nlist = max(1, min(count, int(4 * count ** 0.5)))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = min(IVF_NPROBE, nlist)
+        return index
+    if index_type == "sq8":
+        # int8 codes: 4x smaller than float32
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    if index_type == "pq":
+        return faiss.IndexPQ(dim, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    return faiss.IndexFlatIP(dim)
+
+
+def check_index_type(index_type: str, count: int, dim: Optional[int] = None) -> str:
+    """Falls back to sq8 when the corpus cannot train a PQ index, instead of crashing in faiss."""
+    if index_type != "pq":
+        return index_type
+    if count < 2 ** PQ_NBITS:
+        logger.warning("PQ needs at least %d vectors to train, got %d; using sq8", 2 ** PQ_NBITS, count)
+        return "sq8"
+    if dim is not None and dim % PQ_M:
+        logger.warning("FAISS_PQ_M=%d does not divide the embedding dim %d; using sq8", PQ_M, dim)
+        return "sq8"
+    return index_type
+
+
+def log_recall(index: faiss.Index, vectors: np.ndarray, k: int = 10, samples: int = 200) -> None:
+    """Recall@k of a compressed index against exact search, on a sample of the corpus."""
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    queries = vectors[np.random.default_rng(0).choice(len(vectors), min(samples, len(vectors)), replace=False)]
+    _, truth = exact.search(queries, k)
+    _, found = index.search(queries, k)
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    logger.info("%s recall@%d vs exact: %.3f", type(index).__name__, k, hits / truth.size)
+
+
+def build_store(documents: Sequence[Document], index_type: str = "auto") -> FAISS:
+    texts = [doc.page_content for doc in documents]
+    index_type = check_index_type(index_type, len(texts))
+    if index_type == "pq":
+        # Learn the dimension from one text, so a bad FAISS_PQ_M is caught before paying for the rest
+        embedded = InlineAzureEmbeddings.embed_documents(texts[:1])
+        index_type = check_index_type(index_type, len(texts), len(embedded[0]))
+        embedded += InlineAzureEmbeddings.embed_documents(texts[1:])
+    else:
+        embedded = InlineAzureEmbeddings.embed_documents(texts)
+    vectors = np.asarray(embedded, dtype="float32")
+    faiss.normalize_L2(vectors)
+    index = build_faiss_index(vectors.shape[1], len(vectors), index_type)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    if index_type in ("sq8", "pq"):
+        log_recall(index, vectors)
+    ids = [str(uuid.uuid4()) for _ in documents]
+    logger.info("Built %s over %d vectors", type(index).__name__, index.ntotal)
+    return FAISS(
+        embedding_function=InlineAzureEmbeddings(),
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, documents))),
+        index_to_docstore_id=dict(enumerate(ids)),
+        # Vectors are normalised here rather than via normalize_L2, which LangChain rejects for IP
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+
+
+def load_store() -> FAISS:
+    store = FAISS.load_local(
+        str(FAISS_DIR), InlineAzureEmbeddings(), index_name=INDEX_NAME, allow_dangerous_deserialization=True
+    )
+    # The pickle does not record the metric
+    if store.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        store.distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
+    return store
+
+
+def add_to_store(store: FAISS, documents: Sequence[Document]) -> List[str]:
+    """Embeds and adds documents, normalising them first when the index is cosine (inner product)."""
+    texts = [doc.page_content for doc in documents]
+    vectors = np.asarray(InlineAzureEmbeddings.embed_documents(texts), dtype="float32")
+    if store.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        faiss.normalize_L2(vectors)
+    return store.add_embeddings(zip(texts, vectors.tolist()), metadatas=[doc.metadata for doc in documents])
+
+
+def rebuild_index(
+    documents: Sequence[Document],
+    stamp: str,
+    index_type: str = "auto",
+    parents: Optional[Dict[str, Document]] = None,
+) -> None:
     # Add specific knowledge about CEO
     ceo_doc = Document(
         page_content="The CEO of Twinings Ovaltine is Olav Silden.",
@@ -363,29 +753,53 @@ def rebuild_index(documents: Sequence[Document], stamp: str) -> None:
     )
     faiss_file = FAISS_DIR / f"{INDEX_NAME}.faiss"
     meta_file = FAISS_DIR / f"{INDEX_NAME}.pkl"
+    candidates = list(documents) + [ceo_doc]
     if faiss_file.exists() and meta_file.exists():
-        # Load existing and add CEO
-        store = FAISS.load_local(str(FAISS_DIR), INDEX_NAME, allow_dangerous_deserialization=True)
-        store.add_documents([ceo_doc])
-        logger.info("Added CEO info to existing FAISS index")
+        # Load existing and embed only chunks it has not seen yet
+        store = load_store()
+        manifest = load_manifest(store)
+        new_docs = unique_documents(d for d in candidates if content_hash(d.page_content) not in manifest)
+        if new_docs:
+            ids = add_to_store(store, new_docs)
+            manifest.update(zip((content_hash(d.page_content) for d in new_docs), ids))
+        logger.info("Added %d new docs to existing FAISS index (%d already present)",
+                    len(new_docs), len(candidates) - len(new_docs))
     else:
         # Create new with documents + CEO
-        all_documents = list(documents) + [ceo_doc]
-        store = FAISS.from_documents(all_documents, InlineAzureEmbeddings())
+        all_documents = unique_documents(candidates)
+        store = build_store(all_documents, index_type)
+        manifest = {
+            content_hash(doc.page_content): doc_id
+            for doc_id, doc in store.docstore._dict.items()
+        }
         logger.info("Created new FAISS index with %d docs", len(all_documents))
+    add_parents(store, parents or {})
     backup_index(stamp)
     store.save_local(str(FAISS_DIR), INDEX_NAME)
+    save_manifest(manifest)
     logger.info("FAISS store saved")
 
 
-def load_jsonl(path: Path) -> List[Dict[str, Any]]:
-    rows: List[Dict[str, Any]] = []
-    with path.open("r", encoding="utf-8") as fh:
+def load_jsonl(path: Path) -> Iterator[Dict[str, Any]]:
+    with path.open("rb") as fh:
         for line in fh:
             line = line.strip()
             if line:
-                rows.append(json.loads(line))
-    return rows
+                yield orjson.loads(line)
+
+
+def load_raw_records(path: Path, run_id: str) -> Iterator[RawRecord]:
+    for item in load_jsonl(path):
+        yield RawRecord(
+            url=item["url"],
+            title=item.get("title", "Unknown"),
+            # Raw files from before harvest-time sanitizing still carry the HTML
+            text=item.get("text") or sanitize_text(item.get("html", ""), item.get("markdown", "")),
+            markdown=item.get("markdown", ""),
+            crawled_at=item.get("crawled_at", run_id),
+            links=item.get("links", []),
+            raw_html_path=item.get("raw_html_path"),
+        )
 
 
 def parse_args() -> argparse.Namespace:
@@ -393,8 +807,23 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--max-pages", type=int, default=1000)
     parser.add_argument("--per-page-link-cap", type=int, default=10)
     parser.add_argument("--chunk-size", type=int, default=700)
-    parser.add_argument("--chunk-overlap", type=int, default=120)
+    # Overlap re-embeds the same text in neighbouring chunks; parents already supply the surrounding context
+    parser.add_argument("--chunk-overlap", type=int, default=0)
+    parser.add_argument(
+        "--parent-chunk-size",
+        type=int,
+        default=PARENT_CHUNK_SIZE,
+        help="Size of the parent passages returned for matched chunks (0 disables small-to-big)",
+    )
+    parser.add_argument(
+        "--index-type",
+        choices=["auto", "flat", "hnsw", "ivf", "sq8", "pq"],
+        default="auto",
+        help="FAISS index for a fresh build; auto picks flat below FAISS_HNSW_MIN_VECTORS, else hnsw. "
+             "sq8/pq quantize vectors (4x/~100x smaller) and log recall@10 against exact search",
+    )
     parser.add_argument("--skip-crawl", action="store_true")
+    parser.add_argument("--keep-html", action="store_true", help="Keep gzipped raw HTML under raw/binary")
     parser.add_argument("--raw-path", type=str)
     parser.add_argument("--seed-file", type=str)
     parser.add_argument("--use-ddg", action="store_true", help="Use DuckDuckGo advanced search to expand seeds")
@@ -414,7 +843,8 @@ def load_seed_file(path: Path) -> List[str]:
 
 
 def hash_text(content: str) -> str:
-    return hashlib.sha1(content.encode("utf-8", errors="ignore")).hexdigest()
+    # File-name fingerprint only, so a non-cryptographic hash is enough
+    return xxhash.xxh3_64_hexdigest(content.encode("utf-8", errors="ignore"))
 
 
 def canonicalize_url(url: str) -> str:
@@ -422,42 +852,84 @@ def canonicalize_url(url: str) -> str:
     return lowered.rstrip("/")
 
 
+def run_ddg_query(query: str, max_results: int) -> List[str]:
+    urls: List[str] = []
+    try:
+        # One DDGS per thread; the client keeps per-session state
+        for item in DDGS().text(query, max_results=max_results, safesearch="off", region="wt-wt"):
+            link = item.get("href") or item.get("url")
+            if link:
+                urls.append(link)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("DDG search failure for %s: %s", query, exc)
+    return urls
+
+
 def run_ddg_queries(queries: Sequence[str], max_results: int) -> List[str]:
-    ddg = DDGS()
+    if not queries:
+        return []
     urls: List[str] = []
-    for query in queries:
-        try:
-            for item in ddg.text(query, max_results=max_results, safesearch="off", region="wt-wt"):
-                link = item.get("href") or item.get("url")
-                if link:
-                    urls.append(link)
-        except Exception as exc:  # noqa: BLE001
-            logger.warning("DDG search failure for %s: %s", query, exc)
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        for links in pool.map(lambda q: run_ddg_query(q, max_results), queries):
+            urls.extend(links)
     return urls
 
 
-def fetch_pdf(url: str) -> Optional[str]:
+def extract_pdf_text(content: bytes) -> str:
+    """Runs in a worker process; PDFium is not thread-safe."""
+    pdf = pdfium.PdfDocument(content)
     try:
-        resp = requests.get(url, timeout=30)
-        resp.raise_for_status()
-        if "application/pdf" not in resp.headers.get("Content-Type", ""):
-            return None
-        if len(resp.content) > MAX_PDF_BYTES:
-            logger.info("Skipping PDF over size limit: %s", url)
-            return None
-        from pdfminer.high_level import extract_text
-        text = extract_text(io.BytesIO(resp.content))
+        return "\n".join(page.get_textpage().get_text_range() for page in pdf)
+    finally:
+        pdf.close()
+
+
+async def fetch_pdf_async(
+    client: httpx.AsyncClient,
+    url: str,
+    semaphore: asyncio.Semaphore,
+    pool: ProcessPoolExecutor,
+) -> Optional[str]:
+    try:
+        async with semaphore:
+            async with client.stream("GET", url, timeout=30) as resp:
+                resp.raise_for_status()
+                # Decide from the headers alone so HTML pages are never downloaded twice
+                if "application/pdf" not in resp.headers.get("Content-Type", ""):
+                    return None
+                if int(resp.headers.get("Content-Length") or 0) > MAX_PDF_BYTES:
+                    logger.info("Skipping PDF over size limit: %s", url)
+                    return None
+                content = bytearray()
+                async for part in resp.aiter_bytes():
+                    content.extend(part)
+                    if len(content) > MAX_PDF_BYTES:
+                        logger.info("Skipping PDF over size limit: %s", url)
+                        return None
+
+        content = bytes(content)
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(pool, extract_pdf_text, content)
         if text:
             pdf_hash = hash_text(url)
             pdf_path = RAW_BINARY_DIR / f"{pdf_hash}.pdf"
             with pdf_path.open("wb") as fh:
-                fh.write(resp.content)
+                fh.write(content)
             return text
     except Exception as exc:  # noqa: BLE001
         logger.warning("Failed to fetch PDF %s: %s", url, exc)
     return None
 
 
+async def fetch_pdfs(urls: Sequence[str]) -> List[Optional[str]]:
+    semaphore = asyncio.Semaphore(PDF_CONCURRENCY)
+    with ProcessPoolExecutor() as pool:
+        async with httpx.AsyncClient(follow_redirects=True) as client:
+            return await asyncio.gather(
+                *(fetch_pdf_async(client, url, semaphore, pool) for url in urls)
+            )
+
+
 def expand_seeds(base_seeds: List[str], ddg_queries: Sequence[str], ddg_results: int) -> List[str]:
     search_urls = run_ddg_queries(ddg_queries, ddg_results)
     combined = base_seeds + search_urls
@@ -481,56 +953,58 @@ async def main() -> None:
 
         start_time = datetime.utcnow().isoformat()
 
-        raw_records: List[RawRecord] = []
         if args.skip_crawl:
             if not args.raw_path:
                 raise ValueError("--raw-path required when using --skip-crawl")
-            raw_items = load_jsonl(Path(args.raw_path))
-            raw_records = [
-                RawRecord(
-                    url=item["url"],
-                    title=item.get("title", "Unknown"),
-                    html=item.get("html", ""),
-                    markdown=item.get("markdown", ""),
-                    crawled_at=item.get("crawled_at", run_id),
-                    links=item.get("links", []),
-                )
-                for item in raw_items
-            ]
-            logger.info("Loaded %d raw records", len(raw_records))
+            raw_path = Path(args.raw_path)
         else:
+            raw_path = RAW_DIR / f"twinings_raw_{run_id}.jsonl"
             try:
-                raw_records = await asyncio.wait_for(
-                    crawl(seeds, max_pages=args.max_pages, per_page_limit=args.per_page_link_cap),
+                await asyncio.wait_for(
+                    crawl(
+                        seeds,
+                        raw_path,
+                        max_pages=args.max_pages,
+                        per_page_limit=args.per_page_link_cap,
+                        keep_html=args.keep_html,
+                    ),
                     timeout=30 * 60  # 30 minutes in seconds
                 )
             except asyncio.TimeoutError:
                 logger.info("Crawl timed out after 30 minutes; proceeding with available data")
-            if raw_records:
-                raw_path = RAW_DIR / f"twinings_raw_{run_id}.jsonl"
-                write_jsonl(raw_path, (record.to_json() for record in raw_records))
-                logger.info("Saved raw crawl to %s", raw_path)
+            logger.info("Saved raw crawl to %s", raw_path)
 
+        raw_records: Iterable[RawRecord] = load_raw_records(raw_path, run_id)
         if args.include_pdfs:
-            for record in raw_records:
-                pdf_text = fetch_pdf(record.url)
+            raw_records = list(raw_records)
+            pdf_texts = await fetch_pdfs([record.url for record in raw_records])
+            for record, pdf_text in zip(raw_records, pdf_texts):
                 if pdf_text:
-                    record.markdown += "\n" + pdf_text
+                    record.text = collapse_whitespace(f"{record.text} {pdf_text}")
 
         cleaned_docs = clean(raw_records)
         clean_path = PROCESSED_DIR / f"twinings_clean_{run_id}.jsonl"
         write_jsonl(clean_path, cleaned_docs)
         logger.info("Saved cleaned docs to %s", clean_path)
 
-        chunks = chunk_docs(cleaned_docs, run_id, args.chunk_size, args.chunk_overlap)
+        chunks, parents = chunk_docs(
+            cleaned_docs, run_id, args.chunk_size, args.chunk_overlap, args.parent_chunk_size
+        )
         chunk_path = PROCESSED_DIR / f"twinings_chunks_{run_id}.jsonl"
         serialize_docs(chunk_path, chunks)
         logger.info("Saved chunks to %s", chunk_path)
+        if parents:
+            parent_path = PROCESSED_DIR / f"twinings_parents_{run_id}.jsonl"
+            write_jsonl(
+                parent_path,
+                ({"id": pid, "page_content": d.page_content, "metadata": d.metadata} for pid, d in parents.items()),
+            )
+            logger.info("Saved parents to %s", parent_path)
 
-        rebuild_index(chunks, run_id)
+        rebuild_index(chunks, run_id, args.index_type, parents)
     else:
         logger.info("Adding CEO information to existing index")
-        rebuild_index([], run_id)
+        rebuild_index([], run_id, args.index_type)
     logger.info("Index rebuild complete")
 
 